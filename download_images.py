@@ -5,27 +5,77 @@ Version: 1.0.3
 """
 import requests
 from requests.adapters import HTTPAdapter, Retry
-from bs4 import BeautifulSoup
+from urllib3.util.connection import allowed_gai_family
+from selectolax.lexbor import LexborHTMLParser
+import xxhash
 from urllib.parse import urljoin, urlparse
 import os
+import re
+import shutil
+import socket
+import sys
 import concurrent.futures
 import csv
+import queue
 from tqdm import tqdm
-from threading import Lock
+from threading import Event, Thread, local
 import itertools
 import argparse
 import time
 import logging
+import math
+from functools import lru_cache
 from PIL import Image
-import hashlib
-from io import BytesIO
+import numpy as np
+from io import BytesIO, StringIO
 
-# Global flag to signal shutdown
-shutdown_flag = False
+# Set to signal shutdown
+shutdown_event = Event()
+
+# Crawling is I/O-bound: threads spend most of their time waiting on sockets,
+# so run several per core rather than one.
+DEFAULT_THREADS = min(64, (os.cpu_count() or 1) * 8)
+
+# Chunk size used when streaming an image body straight to disk
+COPY_CHUNK = 64 * 1024
+
+# Sizing of the Bloom filter that tracks already-downloaded image URLs
+URL_FILTER_CAPACITY = 10_000_000
+URL_FILTER_ERROR_RATE = 0.001
+
+# Images whose dHashes differ in at most this many bits count as duplicates
+DUPLICATE_RADIUS = 4
+
+# Hashing stage: worker threads, and downloaded images allowed to wait for them
+HASH_WORKERS = 2
+HASH_QUEUE_SIZE = 256
+
+# metadata.csv is flushed to disk once this many rows are buffered
+METADATA_BATCH = 64
+
+# Per-thread state (each worker gets its own HTTP session and connection pool)
+_tls = local()
+
+
+@lru_cache(maxsize=65536)
+def cached_urlparse(url):
+    return urlparse(url)
+
+
+def join_url(base, parent, src):
+    """
+    urljoin(base, src) with the common absolute and root-relative forms
+    resolved by hand; ``parent`` is cached_urlparse(base).
+    """
+    if src.startswith(("http://", "https://")):
+        return src
+    if src.startswith("/") and not src.startswith("//") and "/." not in src:
+        return f"{parent.scheme}://{parent.netloc}{src}"
+    return urljoin(base, src)
 
 
 def get_domain_name(url):
-    netloc = urlparse(url).netloc.lower()
+    netloc = cached_urlparse(url).netloc.lower()
     domain = netloc.split(":")[0]
     return domain.replace("www.", "") or "images"
 
@@ -42,134 +92,384 @@ def init_session():
     return session
 
 
+_getaddrinfo = socket.getaddrinfo
+
+
+@lru_cache(maxsize=100_000)
+def _resolve(host, port, family, type, proto, flags):
+    return _getaddrinfo(host, port, family, type, proto, flags)
+
+
+def cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """socket.getaddrinfo with results kept for the rest of the run."""
+    return _resolve(host, port, family, type, proto, flags)
+
+
+def install_dns_cache(urls, workers):
+    """
+    Route every DNS lookup (urllib3's included) through cached_getaddrinfo,
+    then resolve the hosts of ``urls`` in parallel so crawling starts warm.
+    """
+    socket.getaddrinfo = cached_getaddrinfo
+    targets = set()
+    for url in urls:
+        try:
+            parts = urlparse(url)
+            if parts.hostname:
+                port = parts.port or (443 if parts.scheme == "https" else 80)
+                targets.add((parts.hostname, port))
+        except ValueError:
+            continue  # malformed, e.g. a bad port; the crawl logs it as failed
+
+    def resolve(target):
+        # Same arguments urllib3 uses, so its later lookups hit the cache
+        try:
+            socket.getaddrinfo(target[0], target[1], allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError as e:
+            logging.warning(f"Could not resolve {target[0]}: {e}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(resolve, targets))
+
+
+def get_session():
+    """Return the calling thread's session, creating it on first use."""
+    session = getattr(_tls, "session", None)
+    if session is None:
+        session = _tls.session = init_session()
+    return session
+
+
 def hash_image_bytes(img_bytes):
-    """Return SHA256 hash of image bytes for duplicate detection."""
+    """
+    Return the 64-bit difference hash (dHash) of an image for near-duplicate
+    detection: one bit per horizontally adjacent pixel pair of a 9x8
+    grayscale thumbnail, set where brightness increases.
+    """
     try:
         img = Image.open(BytesIO(img_bytes))
-        img = img.convert("RGB")
-        img = img.resize((64, 64))
-        return hashlib.sha256(img.tobytes()).hexdigest()
+        # Let the JPEG decoder downscale in the DCT domain (up to 8x) instead
+        # of decoding every pixel only to throw most of them away.
+        img.draft("L", (9, 8))
+        img = img.convert("L").resize((9, 8), Image.BOX)
+        a = np.asarray(img, dtype=np.int16)
+        diff = a[:, 1:] > a[:, :-1]
+        return int.from_bytes(np.packbits(diff).tobytes(), "big")
     except Exception:
         return None
 
 
-def download_image(session, url, save_path, timeout=10, hash_set=None, lock=None, throttle=0, auth=None):
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of image hashes under Hamming distance, so checking
+    for a near-duplicate visits a few branches instead of every stored hash.
+
+    Nodes are ``(hash, {distance: child})`` and new children are attached
+    with dict.setdefault, which is atomic under the GIL, so concurrent add()
+    calls never drop each other's entries.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, h):
+        node = self._root.setdefault(0, (h, {}))
+        while True:
+            value, children = node
+            dist = hamming(h, value)
+            if dist == 0:
+                return
+            new = (h, {})
+            node = children.setdefault(dist, new)
+            if node is new:
+                return
+
+    def find(self, h, radius):
+        """Return True if a stored hash is within ``radius`` bits of ``h``."""
+        stack = list(self._root.values())
+        while stack:
+            value, children = stack.pop()
+            dist = hamming(h, value)
+            if dist <= radius:
+                return True
+            for d in range(max(1, dist - radius), dist + radius + 1):
+                child = children.get(d)
+                if child is not None:
+                    stack.append(child)
+        return False
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings, used for the set of downloaded
+    image URLs: about 1.8 bytes per entry at a 0.1% error rate instead of
+    the hundred-plus bytes a set pays per URL string. Membership tests can
+    give false positives at roughly ``error_rate``, never false negatives.
+
+    add() is a read-modify-write on the bit array, so only one thread may
+    add; any number may test membership concurrently.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k indexes derived from one 128-bit digest. xxh3 is
+        # non-cryptographic, which is all a Bloom filter needs, and far faster.
+        digest = xxhash.xxh3_128_intdigest(key.encode())
+        h1 = digest & 0xFFFFFFFFFFFFFFFF
+        h2 = (digest >> 64) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def request_image(url, timeout, throttle, auth):
+    if throttle:
+        time.sleep(throttle)
+    resp = get_session().get(url, timeout=timeout, stream=True, auth=auth)
+    resp.raise_for_status()
+    resp.raw.decode_content = True
+    return resp
+
+
+def download_image(url, timeout=10, throttle=0, auth=None):
+    """Return the image body for the hashing stage, or None on failure."""
     try:
-        if throttle:
-            time.sleep(throttle)
-        resp = session.get(url, timeout=timeout, stream=True, auth=auth)
-        resp.raise_for_status()
-        img_bytes = resp.content
-        img_hash = hash_image_bytes(img_bytes) if hash_set is not None else None
-        if hash_set is not None and img_hash:
-            with lock:
-                if img_hash in hash_set:
-                    return False  # Duplicate
-                hash_set.add(img_hash)
-        with open(save_path, "wb") as f:
-            f.write(img_bytes)
+        # Read the whole body in one call rather than in small iter_content chunks
+        return request_image(url, timeout, throttle, auth).raw.read()
+    except Exception as e:
+        logging.error(f"Failed to download {url}: {e}")
+        return None
+
+
+def stream_image(url, save_path, timeout=10, throttle=0, auth=None):
+    """Stream an image straight to disk in large chunks (no dedup)."""
+    try:
+        resp = request_image(url, timeout, throttle, auth)
+        with open(save_path, "wb", buffering=0) as f:
+            shutil.copyfileobj(resp.raw, f, length=COPY_CHUNK)
         return True
     except Exception as e:
         logging.error(f"Failed to download {url}: {e}")
+        # Don't leave a truncated body behind when the transfer broke off
+        try:
+            os.remove(save_path)
+        except OSError:
+            pass
         return False
 
 
 def parse_and_download(
-    session, url, output_dir, downloaded_urls, index_counter, image_bar, lock,
-    allowed_exts, hash_set, throttle, depth, visited, auth
+    url, output_dir, downloaded_urls, index_counter, image_bar,
+    ext_pattern, throttle, depth, auth, hash_queue, write_queue, seen=None
 ):
     """
-    Recursively parses a URL, downloads images, and returns stats.
+    Parses one page and downloads its images, returning
+    ``(found, failed, links)`` where ``links`` are the same-host pages to
+    crawl next (only collected while ``depth > 0``). Downloaded bodies go
+    to ``hash_queue`` for the hashing stage; with no hash queue (dedup off)
+    images are streamed to disk here and their rows go straight to
+    ``write_queue``.
+
+    ``downloaded_urls`` is only read here; pages claim the image URLs they
+    download in ``seen``, one dict shared by every page of the run, and the
+    metadata writer later merges them into ``downloaded_urls``. Pages are
+    deduplicated by the caller before they are submitted.
     """
-    metadata = []
-    found = downloaded = failed = 0
-    if url in visited or shutdown_flag or depth < 0:
-        return metadata, found, downloaded, failed
-    visited.add(url)
+    found = failed = 0
+    links = []
+    if shutdown_event.is_set():
+        return found, failed, links
+    if seen is None:
+        seen = {}
+    claim = object()  # this page's mark in seen
     try:
-        resp = session.get(url, timeout=10, auth=auth)
+        parent = cached_urlparse(url)
+        resp = get_session().get(url, timeout=10, auth=auth)
         resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-        imgs = soup.find_all("img")
-        img_srcs = [img.get("src") for img in imgs if img.get("src")]
-        # Filter by extension
+        # selectolax's C (lexbor) parser instead of the pure-Python
+        # html.parser; passing bytes also skips resp.text's charset sniffing.
+        tree = LexborHTMLParser(resp.content)
         img_srcs = [
-            src for src in img_srcs
-            if any(src.lower().endswith(ext) for ext in allowed_exts)
+            img.attributes.get("src") for img in tree.css("img")
+            if img.attributes.get("src")
         ]
+        # Filter by extension
+        img_srcs = [src for src in img_srcs if ext_pattern.search(src)]
         found = len(img_srcs)
-        with lock:
-            image_bar.total += found
-            image_bar.refresh()
         for src in img_srcs:
-            if shutdown_flag:
+            if shutdown_event.is_set():
                 break
-            img_url = urljoin(url, src)
-            with lock:
-                if img_url in downloaded_urls:
-                    continue
-                downloaded_urls.add(img_url)
-                local_index = next(index_counter)
-            ext = os.path.splitext(urlparse(img_url).path)[1] or ".jpg"
+            img_url = join_url(url, parent, src)
+            # setdefault is atomic under the GIL, so of the pages racing for
+            # an image URL exactly one sees its own claim come back
+            if img_url in downloaded_urls or seen.setdefault(img_url, claim) is not claim:
+                continue
+            local_index = next(index_counter)
+            ext = os.path.splitext(cached_urlparse(img_url).path)[1] or ".jpg"
             fname = f"img_{local_index:06d}{ext}"
-            save_path = os.path.join(output_dir, fname)
-            if download_image(session, img_url, save_path, hash_set=hash_set, lock=lock, throttle=throttle, auth=auth):
-                metadata.append((fname, img_url, url))
-                downloaded += 1
+            if hash_queue is None:
+                save_path = os.path.join(output_dir, fname)
+                if stream_image(img_url, save_path, throttle=throttle, auth=auth):
+                    write_queue.put((fname, img_url, url, ""))
+                else:
+                    failed += 1
             else:
-                failed += 1
-            with lock:
-                image_bar.update(1)
-        # Recursive crawling
+                img_bytes = download_image(img_url, throttle=throttle, auth=auth)
+                if img_bytes is not None:
+                    # Blocks while the hashers are behind, capping memory use
+                    hash_queue.put((fname, img_url, url, img_bytes))
+                else:
+                    failed += 1
+            image_bar.update(1)
+        # Links for the next crawl level; the caller schedules them
         if depth > 0:
-            links = [a.get("href") for a in soup.find_all("a", href=True)]
-            for link in links:
-                next_url = urljoin(url, link)
-                if urlparse(next_url).netloc == urlparse(url).netloc:
-                    m, f, d, fa = parse_and_download(
-                        session, next_url, output_dir, downloaded_urls, index_counter,
-                        image_bar, lock, allowed_exts, hash_set, throttle, depth-1, visited, auth
-                    )
-                    metadata.extend(m)
-                    found += f
-                    downloaded += d
-                    failed += fa
+            hrefs = [
+                a.attributes.get("href") for a in tree.css("a[href]")
+                if a.attributes.get("href") is not None
+            ]
+            for href in hrefs:
+                next_url = join_url(url, parent, href)
+                if cached_urlparse(next_url).netloc == parent.netloc:
+                    links.append(next_url)
     except Exception as e:
         failed += 1
         logging.error(f"Failed to parse {url}: {e}")
-    return metadata, found, downloaded, failed
+    return found, failed, links
 
 
-def load_existing_metadata(meta_path):
-    downloaded = set()
+def load_existing(meta_path, load_hashes=True):
+    """
+    Read metadata.csv in one pass and return ``(url_filter, hash_tree)``:
+    the image URLs already downloaded and, unless ``load_hashes`` is false
+    (hash_tree is then None), a BK-tree of their perceptual hashes.
+    """
+    downloaded = BloomFilter(URL_FILTER_CAPACITY, URL_FILTER_ERROR_RATE)
+    hashes = BKTree() if load_hashes else None
     if os.path.exists(meta_path):
-        with open(meta_path, "r", newline="") as f:
-            reader = csv.DictReader(f)
+        with open(meta_path, "r", newline="", buffering=1 << 20) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None or "image_url" not in header:
+                return downloaded, hashes
+            # Positional indexing is much cheaper than a dict per row
+            url_col = header.index("image_url")
+            # Files from before hashing was added have no img_hash column
+            hash_col = header.index("img_hash") if hashes is not None and "img_hash" in header else None
             for row in reader:
-                downloaded.add(row["image_url"])
-    return downloaded
+                if len(row) <= url_col:
+                    continue
+                downloaded.add(row[url_col])
+                # Skip empty hashes and SHA256 digests written by older versions
+                if hash_col is not None and hash_col < len(row) and len(row[hash_col]) == 16:
+                    hashes.add(int(row[hash_col], 16))
+    return downloaded, hashes
 
 
-def load_existing_hashes(meta_path):
-    hashes = set()
-    if os.path.exists(meta_path):
-        with open(meta_path, "r", newline="") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if "img_hash" in row:
-                    hashes.add(row["img_hash"])
-    return hashes
-
+class CsvAppender:
+    """
+    Keeps metadata.csv open for the whole run and appends rows in bulk:
+    each append_many() call formats all rows into one string and issues a
+    single write into a 1 MiB buffer.
+    """
 
-def append_metadata(meta_path, rows):
     header = ["filename", "image_url", "page_url", "img_hash"]
-    new_file = not os.path.exists(meta_path)
-    with open(meta_path, "a", newline="") as f:
-        writer = csv.writer(f)
+
+    def __init__(self, meta_path):
+        self.meta_path = meta_path
+        self.pending = 0
+        self._file = None
+
+    def __enter__(self):
+        new_file = not os.path.exists(self.meta_path)
+        self._file = open(self.meta_path, "a", newline="", buffering=1 << 20)
         if new_file:
-            writer.writerow(header)
-        for row in rows:
-            writer.writerow(row)
+            self.append_many([self.header])
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+
+    def append_many(self, rows):
+        buf = StringIO()
+        csv.writer(buf).writerows(rows)
+        self._file.write(buf.getvalue())
+        self.pending += len(rows)
+
+    def flush(self):
+        self._file.flush()
+        self.pending = 0
+
+
+def hash_images(hash_queue, write_queue, output_dir, hash_tree):
+    """
+    Hashing stage: takes downloaded ``(fname, img_url, page_url, img_bytes)``
+    items, drops near-duplicates, saves the rest and passes their metadata
+    rows to the writer. Dropped images are sent as rows with no filename.
+    Stops when it receives ``None``.
+    """
+    while True:
+        item = hash_queue.get()
+        if item is None:
+            break
+        fname, img_url, page_url, img_bytes = item
+        img_hash = hash_image_bytes(img_bytes)
+        if img_hash is not None:
+            # Two hashers racing on the same new image can at worst both keep
+            # their copy.
+            if hash_tree.find(img_hash, DUPLICATE_RADIUS):
+                write_queue.put((None, img_url, page_url, None))
+                continue
+            hash_tree.add(img_hash)
+        try:
+            with open(os.path.join(output_dir, fname), "wb", buffering=0) as f:
+                f.write(img_bytes)
+        except OSError as e:
+            logging.error(f"Failed to save {img_url}: {e}")
+            write_queue.put((None, img_url, page_url, None))
+            continue
+        img_hash = f"{img_hash:016x}" if img_hash is not None else ""
+        write_queue.put((fname, img_url, page_url, img_hash))
+
+
+def write_metadata(write_queue, meta_file, downloaded_urls, stats):
+    """
+    Single writer for metadata rows: merges image URLs into
+    ``downloaded_urls``, counts saved and dropped images in ``stats`` and
+    appends rows to the CSV, flushing every METADATA_BATCH rows. Stops
+    when it receives ``None``.
+    """
+    with CsvAppender(meta_file) as appender:
+        rows = []
+        while True:
+            row = write_queue.get()
+            if row is None:
+                break
+            downloaded_urls.add(row[1])
+            if row[0] is None:
+                stats["dropped"] += 1
+                continue
+            stats["downloaded"] += 1
+            rows.append(row)
+            # Format rows in bulk, but don't hold them back while the queue is idle
+            if len(rows) >= METADATA_BATCH or write_queue.empty():
+                appender.append_many(rows)
+                rows = []
+                if appender.pending >= METADATA_BATCH:
+                    appender.flush()
+        appender.append_many(rows)
 
 
 def print_summary(
@@ -203,9 +503,10 @@ def main():
     parser = argparse.ArgumentParser(description="ImCrawler - Image Crawler & Downloader")
     parser.add_argument("url_list_file", help="File containing list of URLs")
     parser.add_argument("-o", "--output", default=None, help="Output directory")
-    parser.add_argument("-t", "--threads", type=int, default=os.cpu_count() or 4, help="Number of threads")
+    parser.add_argument("-t", "--threads", type=int, default=DEFAULT_THREADS, help="Number of threads")
     parser.add_argument("-e", "--ext", nargs="+", default=[".jpg", ".jpeg", ".png", ".gif"], help="Allowed image extensions")
     parser.add_argument("-d", "--depth", type=int, default=0, help="Recursive crawl depth (0 = no recursion)")
+    parser.add_argument("--no-dedup", action="store_true", help="Skip duplicate-image detection and stream images straight to disk")
     parser.add_argument("--throttle", type=float, default=0, help="Seconds to wait between downloads")
     parser.add_argument("--username", help="HTTP Basic Auth username")
     parser.add_argument("--password", help="HTTP Basic Auth password")
@@ -233,93 +534,124 @@ def main():
     if resuming:
         print("Welcome back! Resuming from previous operation...\n")
 
-    session = init_session()
-    downloaded_urls = load_existing_metadata(meta_file)
-    hash_set = set()
-    lock = Lock()
+    downloaded_urls, hash_tree = load_existing(meta_file, load_hashes=not args.no_dedup)
     index_counter = itertools.count()
-    visited = set()
     auth = (args.username, args.password) if args.username and args.password else None
-
-    # Resume: load hashes if present
-    if os.path.exists(meta_file):
-        with open(meta_file, "r", newline="") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if "img_hash" in row:
-                    hash_set.add(row["img_hash"])
+    install_dns_cache(urls, args.threads)
+    # One compiled, case-insensitive alternation instead of an endswith() per extension
+    ext_pattern = re.compile("(?:" + "|".join(re.escape(ext) for ext in args.ext) + ")$", re.I)
 
     # Progress bars
     total_sites = len(urls)
-    sites_visited = total_found = total_downloaded = total_failed = 0
-    site_bar = tqdm(total=total_sites, desc="Processing sites", unit="site")
-    image_bar = tqdm(total=0, desc="Downloading images", unit="img")
+    # sites/found/failed are updated by this thread, downloaded/dropped by the writer
+    stats = {"sites": 0, "found": 0, "failed": 0, "downloaded": 0, "dropped": 0}
+    # No bars when stderr is not a terminal, and throttled redraws otherwise:
+    # image_bar is updated from every download thread
+    bar_options = {"disable": not sys.stderr.isatty(), "mininterval": 0.5}
+    site_bar = tqdm(total=total_sites, desc="Processing sites", unit="site", **bar_options)
+    image_bar = tqdm(desc="Downloading images", unit="img", miniters=32, **bar_options)
+
+    # Pipeline: download threads -> hash_queue -> hashers -> write_queue -> writer
+    hash_queue = None if hash_tree is None else queue.Queue(maxsize=HASH_QUEUE_SIZE)
+    write_queue = queue.Queue()
+    writer = Thread(
+        target=write_metadata,
+        args=(write_queue, meta_file, downloaded_urls, stats),
+        daemon=True,
+    )
+    hashers = [
+        Thread(target=hash_images, args=(hash_queue, write_queue, output_dir, hash_tree), daemon=True)
+        for _ in range(HASH_WORKERS if hash_queue is not None else 0)
+    ]
+    writer.start()
+    for hasher in hashers:
+        hasher.start()
+    # Breadth-first crawl: every page is its own task, and the links a page
+    # returns are submitted from here, so no worker ever waits on another.
+    # Finished pages arrive on done_queue, so handling one costs the same
+    # however many are still pending.
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.threads)
-    futures = [
-        executor.submit(
+    done_queue = queue.Queue()
+    futures = {}  # future -> (site index, depth)
+    active = [0] * total_sites  # pages still queued or running, per site
+    visited = set()  # only touched by this thread, so no lock is needed
+    # Image URLs claimed so far, shared by all pages so an image on several
+    # sites (a logo, a CDN asset) is fetched once before the writer sees it
+    seen = {}
+
+    def submit(url, site, depth):
+        if url in visited:
+            return
+        visited.add(url)
+        future = executor.submit(
             parse_and_download,
-            session,
             url,
             output_dir,
             downloaded_urls,
             index_counter,
             image_bar,
-            lock,
-            args.ext,
-            hash_set,
+            ext_pattern,
             args.throttle,
-            args.depth,
-            visited,
+            depth,
             auth,
+            hash_queue,
+            write_queue,
+            seen,
         )
-        for url in urls
-    ]
+        futures[future] = (site, depth)
+        future.add_done_callback(done_queue.put)
+        active[site] += 1
+
+    for site, url in enumerate(urls):
+        submit(url, site, args.depth)
+        if not active[site]:  # repeated seed URL
+            stats["sites"] += 1
+            site_bar.update(1)
 
     try:
-        for future in concurrent.futures.as_completed(futures):
-            metadata, found, downloaded, failed = future.result()
-            with lock:
-                # Add hash to metadata
-                meta_rows = []
-                for fname, img_url, page_url in metadata:
-                    img_path = os.path.join(output_dir, fname)
-                    try:
-                        with open(img_path, "rb") as f:
-                            img_hash = hash_image_bytes(f.read())
-                    except Exception:
-                        img_hash = ""
-                    meta_rows.append((fname, img_url, page_url, img_hash))
-                append_metadata(meta_file, meta_rows)
-                sites_visited += 1
-                total_found += found
-                total_downloaded += downloaded
-                total_failed += failed
+        while futures and not shutdown_event.is_set():
+            future = done_queue.get()
+            site, depth = futures.pop(future)
+            found, failed, links = future.result()
+            stats["found"] += found
+            stats["failed"] += failed
+            if not shutdown_event.is_set():
+                for link in links:
+                    submit(link, site, depth - 1)
+            active[site] -= 1
+            if active[site] == 0:
+                stats["sites"] += 1
                 site_bar.update(1)
-            if shutdown_flag:
-                break
     finally:
         for f in futures:
             f.cancel()
-        executor.shutdown(wait=False)
+        # Running pages stop at their next image once shutdown_event is set;
+        # wait for them so nothing is still feeding the pipeline below.
+        executor.shutdown(wait=True)
+        for _ in hashers:
+            hash_queue.put(None)
+        for hasher in hashers:
+            hasher.join()
+        write_queue.put(None)
+        writer.join()
         site_bar.close()
         image_bar.close()
         print_summary(
             total_sites,
-            sites_visited,
-            total_found,
-            total_downloaded,
-            total_failed,
+            stats["sites"],
+            stats["found"],
+            stats["downloaded"],
+            stats["failed"] + stats["dropped"],
             meta_file,
         )
         logging.info("ImCrawler finished.")
 
 if __name__ == "__main__":
-    import sys, signal
+    import signal
 
     # Handle Ctrl+C
     def handle_sigint(signum, frame):
-        global shutdown_flag
-        shutdown_flag = True
+        shutdown_event.set()
         print("\nInterrupt received, shutting down... please wait.")
 
     signal.signal(signal.SIGINT, handle_sigint)
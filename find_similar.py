@@ -9,10 +9,25 @@ import os
 import argparse
 from tqdm import tqdm
 import signal
+import sys
 import json
-from threading import Lock
+import re
+import time
+import queue
+from threading import Event, Thread, local
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import multiprocessing
+from multiprocessing import shared_memory
+try:
+    import orjson  # optional, several times faster than json for big maps
+except ImportError:
+    orjson = None
+try:
+    from numba import njit  # optional, compiled Hamming kernel
+except ImportError:
+    njit = None
 
 # Global shutdown flag
 shutdown_flag = False
@@ -22,8 +37,6 @@ def handle_sigint(signum, frame):
     shutdown_flag = True
     print("\nInterrupt received, stopping... you can resume later.")
 
-signal.signal(signal.SIGINT, handle_sigint)
-
 # ASCII Logo
 logo = r'''
 .___                                         .__                  
@@ -35,26 +48,92 @@ logo = r'''
 
 ImCrawler Similarity Checker v1.0.3 by natig.
 '''  
-print(logo)
 
 # Resume/inliers file
 DATA_FILE = 'inliers.json'
-lock = Lock()
+# Files considered for matching
+IMAGE_EXT = re.compile(r'\.(?:png|jpe?g)$', re.IGNORECASE)
+# Checkpoint inliers.json after this many new results or seconds, whichever first
+SAVE_EVERY = 256
+SAVE_INTERVAL = 10
+
+# Files per worker task; their descriptors are matched against the query together
+MATCH_BATCH = 32
+# Cap on query x candidate distance-matrix entries per product (64 MiB as float32)
+MATCH_BUDGET = 1 << 24
+# Images decoded ahead of feature extraction in each worker
+PREFETCH = 8
+# Longest image edge, in pixels, that features are extracted at
+MAX_SIZE = 1024
+
+# Lowe's ratio test
+RATIO = 0.75
+# ORB matches further apart than this many of the 256 bits are never kept
+MAX_HAMMING = 64
+# RANSAC homography search: most hypotheses per pair, how many are scored
+# together, reprojection error in pixels, and the confidence for stopping early
+RANSAC_ITERS = 500
+RANSAC_CHUNK = 64
+RANSAC_THRESHOLD = 5.0
+RANSAC_CONFIDENCE = 0.99
+
+# Per-image keypoint coordinates and descriptors, kept between runs so a new
+# query only pays for matching. Each file records the image's mtime and size
+# it was computed from; bump CACHE_VERSION to invalidate every file.
+CACHE_DIR = '.cache'
+CACHE_VERSION = 4
+# Query features, stored next to DATA_FILE
+QUERY_CACHE = 'query_cache.npz'
 
-def load_data(directory):
+# Per-thread feature detectors, created on first use and reused afterwards
+_tls = local()
+
+# Query features, set in each worker process by init_worker as read-only
+# views of the parent's shared-memory block (kept open in _query_shm)
+_pts_q = None
+_desc_q = None
+_query_shm = None
+
+def load_data(directory, settings):
+    """
+    The filename -> inliers map saved by an earlier run with the same
+    ``settings`` (query and matching options), or an empty one.
+    """
     path = os.path.join(directory, DATA_FILE)
     if os.path.exists(path):
         with open(path, 'r') as f:
             data = json.load(f)
+        if not isinstance(data, dict) or data.get("settings") != settings:
+            print(f"{DATA_FILE} is for a different query or options, starting over...")
+            return {}
+        data = data["inliers"]
         print(f"Loaded inliers for {len(data)} images, resuming...")
         return data  # dict: filename -> inliers
     return {}  # not processed
 
 
-def save_data(directory, data_map):
+def save_data(directory, data_map, settings):
+    # Write to a temp file and rename so an interrupted save never leaves a
+    # truncated inliers.json behind. Compact output: this runs on every
+    # checkpoint, and indenting roughly doubles the size and the time.
     path = os.path.join(directory, DATA_FILE)
-    with open(path, 'w') as f:
-        json.dump(data_map, f, indent=2)
+    tmp = path + '.tmp'
+    data = {"settings": settings, "inliers": data_map}
+    if orjson is not None:
+        with open(tmp, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def progress_options():
+    """
+    tqdm options: no bar at all when stderr is not a terminal (logs, pipes),
+    and throttled redraws otherwise so fast cached runs are not slowed by it.
+    """
+    return {"disable": not sys.stderr.isatty(), "mininterval": 0.5, "miniters": 32}
 
 
 def setup_logging(verbose, log_file="errors.log"):
@@ -62,62 +141,658 @@ def setup_logging(verbose, log_file="errors.log"):
     logging.basicConfig(filename=log_file, level=level,
                         format='%(asctime)s %(levelname)s: %(message)s')
 
-def compute_features(image_path, method="ORB"):
-    try:
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if image is None or image.size == 0:
-            return None, None
+def get_detector(method="ORB"):
+    """Return this thread's detector for ``method``, so its buffers are reused."""
+    detector = getattr(_tls, method, None)
+    if detector is None:
         if method == "SIFT":
-            sift = cv2.SIFT_create()
-            kp, desc = sift.detectAndCompute(image, None)
+            detector = cv2.SIFT_create()
+        elif method == "ORB_CUDA":
+            detector = cv2.cuda_ORB.create()
         else:
-            orb = cv2.ORB_create()
-            kp, desc = orb.detectAndCompute(image, None)
-        return kp, desc
-    except cv2.error as e:
+            detector = cv2.ORB_create()
+        setattr(_tls, method, detector)
+    return detector
+
+
+@lru_cache(maxsize=None)
+def cuda_available():
+    """
+    Whether OpenCV was built with CUDA and a device is present, so ORB runs
+    on the GPU. Checked on first use rather than at import: querying the
+    device initialises CUDA, which does not survive a fork.
+    """
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def cuda_orb_features(image):
+    """ORB keypoints and descriptors computed on the GPU, returned as host data."""
+    orb = get_detector("ORB_CUDA")
+    gpu_image = cv2.cuda_GpuMat()
+    gpu_image.upload(image)
+    kp_gpu, desc_gpu = orb.detectAndComputeAsync(gpu_image, None)
+    if desc_gpu is None or desc_gpu.empty():
+        return [], None
+    return orb.convert(kp_gpu), desc_gpu.download()
+
+
+def read_bytes(image_path):
+    """The raw contents of ``image_path``, or None if it cannot be read."""
+    try:
+        with open(image_path, 'rb') as f:
+            return f.read()
+    except OSError as e:
         logging.error(f"Error reading {image_path}: {e}")
+        return None
+
+
+def decode_image(buf, reduced=False, max_size=MAX_SIZE):
+    """
+    Decode encoded image bytes to grayscale, shrunk so the longer edge is
+    at most ``max_size`` (0 to keep full size), or return None if they
+    cannot be decoded.
+    """
+    if not buf:
+        return None
+    try:
+        # IMREAD_REDUCED_GRAYSCALE_2 lets the JPEG decoder scale down by 2
+        # while decoding, which also roughly halves extraction time
+        flags = cv2.IMREAD_REDUCED_GRAYSCALE_2 if reduced else cv2.IMREAD_GRAYSCALE
+        image = cv2.imdecode(np.frombuffer(buf, np.uint8), flags)
+    except cv2.error as e:
+        logging.error(f"Error decoding image: {e}")
+        return None
+    if image is None or image.size == 0:
+        return None
+    h, w = image.shape[:2]
+    if max_size and max(h, w) > max_size:
+        # ORB keeps its 500 best features anyway; fewer pixels means fewer
+        # pyramid levels and FAST candidates to get there
+        f = max_size / max(h, w)
+        image = cv2.resize(image, (max(1, round(w * f)), max(1, round(h * f))), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def read_image(image_path, reduced=False, max_size=MAX_SIZE):
+    """read_bytes followed by decode_image."""
+    return decode_image(read_bytes(image_path), reduced, max_size)
+
+
+def compute_features_from_array(image, method="ORB"):
+    if method == "ORB" and cuda_available():
+        try:
+            return cuda_orb_features(image)
+        except cv2.error as e:
+            # e.g. images smaller than the GPU detector's border; use the CPU
+            logging.warning(f"CUDA ORB failed, falling back to CPU: {e}")
+    try:
+        return get_detector(method).detectAndCompute(image, None)
+    except cv2.error as e:
+        logging.error(f"Error extracting features: {e}")
+        return None, None
+
+
+def keypoint_coords(kp):
+    """Nx2 float32 keypoint coordinates, converted in C rather than per KeyPoint."""
+    if not len(kp):
+        return np.empty((0, 2), np.float32)
+    return cv2.KeyPoint_convert(kp).reshape(-1, 2)
+
+
+def _background_map(func, items, depth):
+    """
+    Yield ``func(item)`` for ``items`` in order, computed up to ``depth``
+    results ahead on a background thread. An exception raised by ``func``
+    (or by ``items``) is re-raised here, and the thread stops early once
+    the caller stops iterating.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = Event()
+    done = object()
+
+    def put(ok, value):
+        # Poll rather than block, so a consumer that has gone away never
+        # leaves the thread stuck on a full queue
+        while not stop.is_set():
+            try:
+                q.put((ok, value), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in items:
+                if not put(True, func(item)):
+                    break
+        except Exception as e:
+            put(False, e)
+        finally:
+            # Stops an upstream _background_map (or other generator) too
+            if hasattr(items, "close"):
+                items.close()
+            put(True, done)
+
+    Thread(target=worker, daemon=True).start()
+    try:
+        while True:
+            ok, result = q.get()
+            if not ok:
+                raise result
+            if result is done:
+                return
+            yield result
+    finally:
+        stop.set()
+
+
+def prefetch_images(paths, reduced=False, max_size=MAX_SIZE, depth=PREFETCH):
+    """
+    Yield ``(path, image)`` for ``paths`` in order through two background
+    stages, each up to ``depth`` images ahead: one thread reads file bytes
+    and another decodes them. File reads and imdecode both release the
+    GIL, so disk I/O, JPEG decoding and feature extraction on the caller
+    all overlap.
+    """
+    raw = _background_map(lambda path: (path, read_bytes(path)), paths, depth)
+    return _background_map(lambda item: (item[0], decode_image(item[1], reduced, max_size)), raw, depth)
+
+
+def _write_npz(path, **arrays):
+    # Temp file and rename, so a killed run never leaves a truncated cache file
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            # Descriptors compress well; a typical ORB entry is a few KB
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"Could not write {path}: {e}")
+
+
+def feature_cache_path(cache_dir, image_path, method="ORB", reduced=False, max_size=MAX_SIZE):
+    suffix = ('.r2' if reduced else '') + (f'.m{max_size}' if max_size else '')
+    return os.path.join(cache_dir, f"{os.path.basename(image_path)}.{method}{suffix}.v{CACHE_VERSION}.npz")
+
+
+def stat_stamp(st):
+    """``(mtime_ns, size)`` from a stat result, as an int64 array."""
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
+def file_stamp(path):
+    """stat_stamp of ``path``, or None if it cannot be stat'ed."""
+    try:
+        return stat_stamp(os.stat(path))
+    except OSError:
+        return None
+
+
+def scan_images(directory):
+    """
+    Sorted ``(fname, stamp)`` pairs for the images in ``directory``, from a
+    single scandir pass whose stat results also key the feature cache.
+    """
+    images = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if IMAGE_EXT.search(entry.name) and entry.is_file():
+                images.append((entry.name, stat_stamp(entry.stat())))
+    images.sort(key=lambda image: image[0])
+    return images
+
+
+def phash64(image):
+    """64-bit DCT perceptual hash of a grayscale image, as a Python int."""
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return int(np.packbits(low > np.median(low)).view('>u8')[0])
+
+
+def read_cached_features(cache_path, stamp):
+    """
+    Return cached ``(pts, desc, phash)`` if the cache file was computed
+    from an image with this ``stamp`` (see file_stamp) and holds a
+    float32[N, 2] point array with one descriptor row per point, else None.
+    """
+    if stamp is None:
+        return None
+    try:
+        with np.load(cache_path) as cached:
+            if not np.array_equal(cached['stamp'], stamp):
+                return None
+            pts, desc, phash = cached['pts'], cached['desc'], int(cached['phash'])
+        if pts.dtype == np.float32 and pts.ndim == 2 and pts.shape[1] == 2 and len(desc) == len(pts):
+            return pts, desc, phash
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def features_from_array(image, method="ORB", cache_path=None, stamp=None, phash=None):
+    """
+    ``(pts, desc)`` for a decoded image: keypoint coordinates as one
+    contiguous float32[N, 2] array and the descriptors (uint8[N, 32] for
+    ORB), saved with the source image's ``stamp`` and perceptual hash to
+    ``cache_path`` if both are given. Everything downstream works on these
+    arrays; no KeyPoint objects outlive this call.
+    """
+    if image is None:
+        return None, None
+    kp, desc = compute_features_from_array(image, method)
+    if desc is None:
+        return None, None
+    pts = keypoint_coords(kp)
+    desc = np.ascontiguousarray(desc)
+    if cache_path is not None and stamp is not None:
+        if phash is None:
+            phash = phash64(image)
+        _write_npz(cache_path, stamp=stamp, pts=pts, desc=desc, phash=np.uint64(phash))
+    return pts, desc
+
+
+def load_features(image_path, method="ORB", reduced=False, cache_dir=None, max_size=MAX_SIZE):
+    """
+    Return ``(pts, desc)`` for ``image_path``. With ``cache_dir`` they are
+    read from an earlier run's cache file while the image's mtime and size
+    are unchanged, and written there after being computed.
+    """
+    cache_path = stamp = None
+    if cache_dir is not None:
+        cache_path = feature_cache_path(cache_dir, image_path, method, reduced, max_size)
+        stamp = file_stamp(image_path)
+        cached = read_cached_features(cache_path, stamp)
+        if cached is not None:
+            return cached[:2]
+    return features_from_array(read_image(image_path, reduced, max_size), method, cache_path, stamp)
+
+
+def query_key(query_image, method="ORB", reduced=False, max_size=MAX_SIZE):
+    """
+    Strings identifying the query's features: its path and stat_stamp,
+    ``method``, ``reduced`` and ``max_size``. None if it cannot be stat'ed.
+    """
+    stamp = file_stamp(query_image)
+    if stamp is None:
+        return None
+    return [os.path.abspath(query_image), *map(str, stamp), method, str(reduced), str(max_size)]
+
+
+def load_query_features(query_image, directory, method="ORB", reduced=False, max_size=MAX_SIZE):
+    """
+    load_features for the query image, cached in QUERY_CACHE inside
+    ``directory`` and reused while its query_key is unchanged.
+    """
+    key = query_key(query_image, method, reduced, max_size)
+    if key is None:
         return None, None
+    path = os.path.join(directory, QUERY_CACHE)
+    key = np.array(key)
+    try:
+        with np.load(path) as cached:
+            if np.array_equal(cached['key'], key):
+                return cached['pts'], cached['desc']
+    except (OSError, ValueError, KeyError):
+        pass
+    pts, desc = load_features(query_image, method, reduced, max_size=max_size)
+    if desc is not None:
+        _write_npz(path, key=key, pts=pts, desc=desc)
+    return pts, desc
+
+
+if njit is not None:
+    @njit(inline='always')
+    def _popcount64(x):
+        # SWAR bit count of a uint64, which LLVM lowers to a single popcnt
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+    # Not parallel=True: the process pool already keeps every core busy
+    @njit(cache=True)
+    def _hamming_top2(A, B, offsets):
+        """
+        For each query row of A against each candidate image's rows
+        B[offsets[s]:offsets[s + 1]] (uint64-viewed descriptors), the index
+        and Hamming distance of the nearest row and the second-nearest
+        distance, in one pass without materialising the distance matrix.
+        """
+        n, lanes = A.shape[0], A.shape[1]
+        segments = len(offsets) - 1
+        best = np.zeros((segments, n), np.int64)
+        d_best = np.empty((segments, n), np.int32)
+        d_second = np.empty((segments, n), np.int32)
+        for s in range(segments):
+            start, end = offsets[s], offsets[s + 1]
+            for i in range(n):
+                b1 = b2 = 1 << 30
+                bi = 0
+                for j in range(start, end):
+                    d = 0
+                    for k in range(lanes):
+                        d += _popcount64(A[i, k] ^ B[j, k])
+                    if d < b1:
+                        b2, b1, bi = b1, d, j - start
+                    elif d < b2:
+                        b2 = d
+                best[s, i] = bi
+                d_best[s, i] = b1
+                d_second[s, i] = b2
+        return best, d_best, d_second
+
+
+def descriptor_distances(desc_q, desc_db, method="ORB"):
+    """
+    Distance matrix between the query descriptors (rows) and a stack of
+    candidate descriptors (columns), computed as one matrix product:
+    Hamming distance for ORB's binary descriptors, L2 for SIFT.
+    """
+    if method == "SIFT":
+        q = desc_q.astype(np.float32)
+        d = desc_db.astype(np.float32)
+        sq = (q * q).sum(axis=1)[:, None] + (d * d).sum(axis=1)[None, :] - 2 * (q @ d.T)
+        return np.sqrt(np.maximum(sq, 0))
+    # popcount(a ^ b) == |a| + |b| - 2 * |a & b| on the unpacked bit vectors
+    q = np.unpackbits(desc_q, axis=1).astype(np.float32)
+    d = np.unpackbits(desc_db, axis=1).astype(np.float32)
+    return q.sum(axis=1)[:, None] + d.sum(axis=1)[None, :] - 2 * (q @ d.T)
+
+
+def nearest_two(dist):
+    """Index and distance of each row's nearest column, and the second-nearest distance."""
+    top2 = np.argpartition(dist, 1, axis=1)[:, :2]
+    d2 = np.take_along_axis(dist, top2, axis=1)
+    first = d2.argmin(axis=1)
+    rows = np.arange(len(dist))
+    return top2[rows, first], d2[rows, first], d2[rows, 1 - first]
+
+
+def inliers_from_nearest(pts1, pts2, best, d_best, d_second, min_matches=10, max_distance=np.inf):
+    """
+    Count RANSAC homography inliers between two images from their keypoint
+    coordinates and, for each keypoint of image 1, its nearest neighbour in
+    image 2 (``best``, ``d_best``) and the second-nearest distance. Matches
+    must pass Lowe's ratio test, as with BFMatcher.knnMatch(k=2), and be
+    closer than ``max_distance``. Pairs with ``min_matches`` or fewer good
+    matches cannot have more inliers than that, so they skip RANSAC and
+    score 0; every non-zero score is a geometrically verified inlier count.
+    """
+    if len(pts1) < min_matches or len(pts2) < max(min_matches, 2):
+        return 0
+    good = np.flatnonzero((d_best < RATIO * d_second) & (d_best < max_distance))
+    if len(good) <= min_matches:
+        return 0
+    return count_ransac_inliers(pts1[good], pts2[best[good]], min_matches)
 
 
-def match_and_inliers(kp1, desc1, kp2, desc2, min_matches=10):
-    if shutdown_flag or desc1 is None or desc2 is None or len(kp1) < min_matches or len(kp2) < min_matches:
+def match_and_inliers(pts1, pts2, dist, min_matches=10, max_distance=np.inf):
+    """inliers_from_nearest for a descriptor distance matrix (rows: image 1, columns: image 2)."""
+    if len(pts2) < 2:
         return 0
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = bf.match(desc1, desc2)
-    if len(matches) < min_matches:
+    return inliers_from_nearest(pts1, pts2, *nearest_two(dist), min_matches, max_distance)
+
+
+def _normalize(pts):
+    """Centre ``pts`` on the origin with a mean distance of sqrt(2); returns (pts, scale)."""
+    centred = pts - pts.mean(axis=0)
+    scale = np.sqrt(2) / max(np.sqrt((centred ** 2).sum(axis=1)).mean(), 1e-9)
+    return centred * scale, scale
+
+
+def _score_hypotheses(src, dst, idx, tol2):
+    """Inlier counts of the homographies fitted to each 4-point sample in ``idx``."""
+    x, y = src[idx, 0], src[idx, 1]
+    u, v = dst[idx, 0], dst[idx, 1]
+    zero, one = np.zeros_like(x), np.ones_like(x)
+    # Two DLT rows per correspondence: (samples, 8, 8) systems A h = b
+    rows_u = np.stack([x, y, one, zero, zero, zero, -u * x, -u * y], axis=-1)
+    rows_v = np.stack([zero, zero, zero, x, y, one, -v * x, -v * y], axis=-1)
+    A = np.concatenate([rows_u, rows_v], axis=1)
+    b = np.concatenate([u, v], axis=1)
+    # Drop degenerate samples (repeated or collinear points) before solving
+    ok = np.abs(np.linalg.det(A)) > 1e-9
+    if not ok.any():
+        return np.zeros(0, np.int64)
+    h = np.linalg.solve(A[ok], b[ok][..., None])[..., 0]
+    H = np.concatenate([h, np.ones((len(h), 1))], axis=1).reshape(-1, 3, 3)
+    # (hypotheses, 3, n), applying the last column instead of stacking a row of ones
+    proj = H[:, :, :2] @ src.T + H[:, :, 2:]
+    w = proj[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        err = (proj[:, 0] / w - dst[:, 0]) ** 2 + (proj[:, 1] / w - dst[:, 1]) ** 2
+    return (err < tol2).sum(axis=1)
+
+
+def ransac_trials_needed(inliers, n, confidence=RANSAC_CONFIDENCE):
+    """Trials after which a 4-point RANSAC has, with ``confidence``, drawn one all-inlier sample."""
+    ratio = min(inliers / n, 1.0)
+    if ratio >= 1.0:
+        return 1
+    p_good = ratio ** 4
+    if p_good <= 0.0:
+        return np.inf
+    return np.log(1 - confidence) / np.log1p(-p_good)
+
+
+def count_ransac_inliers(src, dst, min_inliers=0, threshold=RANSAC_THRESHOLD,
+                         iters=RANSAC_ITERS, confidence=RANSAC_CONFIDENCE, seed=0):
+    """
+    Inlier count of the best homography RANSAC finds between Nx2 point sets
+    ``src`` and ``dst``. Only the count is needed, so there is no final
+    refit: hypotheses come from random 4-point samples, solved by DLT with
+    h33 = 1, and are scored RANSAC_CHUNK at a time with one batched
+    projection of ``src``. Seeded, so the same pair always scores the same.
+
+    The search stops adaptively once ``confidence`` says a better model is
+    unlikely: for the best count found so far, or, while that is still
+    ``min_inliers`` or fewer, for a model just above ``min_inliers`` -- so
+    pairs that cannot be similar give up early too.
+    """
+    n = len(src)
+    if n < 4:
         return 0
-    src = np.float32([kp1[m.queryIdx].pt for m in matches]).reshape(-1,1,2)
-    dst = np.float32([kp2[m.trainIdx].pt for m in matches]).reshape(-1,1,2)
-    M, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
-    return int(np.sum(mask)) if mask is not None else 0
+    src, _ = _normalize(src.astype(np.float64))
+    dst, scale = _normalize(dst.astype(np.float64))
+    tol2 = (threshold * scale) ** 2
+    rng = np.random.default_rng(seed)
+    best = done = 0
+    while done < min(iters, ransac_trials_needed(max(best, min_inliers + 1), n, confidence)):
+        count = min(RANSAC_CHUNK, iters - done)
+        scores = _score_hypotheses(src, dst, rng.integers(0, n, (count, 4)), tol2)
+        if len(scores):
+            best = max(best, int(scores.max()))
+        done += count
+    return best
+
+
+def group_by_budget(items, n_query):
+    """Split (fname, pts, desc) items so each distance matrix stays under MATCH_BUDGET."""
+    group, cols = [], 0
+    for item in items:
+        if group and (cols + len(item[2])) * n_query > MATCH_BUDGET:
+            yield group
+            group, cols = [], 0
+        group.append(item)
+        cols += len(item[2])
+    if group:
+        yield group
+
 
+def share_arrays(*arrays):
+    """
+    Copy ``arrays`` into one new SharedMemory block. Returns the block and
+    the ``(offset, shape, dtype)`` specs attach_arrays needs to map them.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(a.nbytes for a in arrays)))
+    specs, offset = [], 0
+    for a in arrays:
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[...] = a
+        specs.append((offset, a.shape, a.dtype.str))
+        offset += a.nbytes
+    return shm, specs
 
-def process_image(args):
-    fname, directory, kp_q, desc_q, threshold, method, verbose = args
-    path = os.path.join(directory, fname)
-    kp, desc = compute_features(path, method)
-    inliers = match_and_inliers(kp_q, desc_q, kp, desc, threshold)
+
+def attach_arrays(name, specs):
+    """Open the SharedMemory block ``name`` and return it with read-only views of its arrays."""
+    shm = shared_memory.SharedMemory(name=name)
+    views = []
+    for offset, shape, dtype in specs:
+        view = np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+        view.flags.writeable = False
+        views.append(view)
+    return shm, views
+
+
+def init_worker(shm_name, specs):
+    """Map the query features, computed once by the parent, into a worker process."""
+    global _pts_q, _desc_q, _query_shm
+    # Ctrl+C is handled by the parent, which stops handing out batches
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Parallelism comes from the process pool; keep OpenCV single-threaded
+    cv2.setNumThreads(1)
+    _query_shm, (_pts_q, _desc_q) = attach_arrays(shm_name, specs)
+
+
+def process_batch(batch, directory, threshold, method, verbose, reduced, max_size,
+                  phash_q=None, max_hash_distance=None):
+    """
+    Extract features for a batch of ``(fname, stamp)`` files, then match
+    all of them against the query in one batched pass instead of one
+    BFMatcher call per image. Runs in a worker set up by init_worker.
+
+    With ``max_hash_distance``, files whose perceptual hash differs from
+    ``phash_q`` in more bits are skipped without feature extraction or
+    matching and reported with ``None`` inliers, so they are not saved.
+    """
+    def far(phash):
+        return max_hash_distance is not None and (phash ^ phash_q).bit_count() > max_hash_distance
+
+    pts_q, desc_q = _pts_q, _desc_q
+    max_distance = MAX_HAMMING if method == "ORB" else np.inf
+    cache_dir = os.path.join(directory, CACHE_DIR)
+    results = []
+    items = []
+    misses = []
+    stamps = {}
+    for fname, stamp in batch:
+        path = os.path.join(directory, fname)
+        stamps[path] = stamp
+        cached = read_cached_features(feature_cache_path(cache_dir, path, method, reduced, max_size), stamps[path])
+        if cached is None:
+            misses.append(path)
+        elif far(cached[2]):
+            results.append((fname, None))
+        else:
+            items.append((fname, *cached[:2]))
+    # Decode the uncached files on a reader thread while extracting features here
+    for path, image in prefetch_images(misses, reduced, max_size):
+        fname = os.path.basename(path)
+        if image is None:
+            results.append((fname, 0))
+            continue
+        phash = phash64(image)
+        if far(phash):
+            results.append((fname, None))
+            continue
+        cache_path = feature_cache_path(cache_dir, path, method, reduced, max_size)
+        pts, desc = features_from_array(image, method, cache_path, stamps[path], phash)
+        if desc is None:
+            results.append((fname, 0))
+        else:
+            items.append((fname, pts, desc))
+    if method == "ORB" and njit is not None and items:
+        # One fused pass over the whole batch: 32-byte descriptors as four
+        # 64-bit words, nearest two per query keypoint and image
+        offsets = np.cumsum([0] + [len(desc) for _, _, desc in items])
+        desc_db = np.ascontiguousarray(np.vstack([desc for _, _, desc in items])).view(np.uint64)
+        best, d_best, d_second = _hamming_top2(np.ascontiguousarray(desc_q).view(np.uint64), desc_db, offsets)
+        for i, (fname, pts, _) in enumerate(items):
+            results.append((fname, inliers_from_nearest(pts_q, pts, best[i], d_best[i], d_second[i], threshold, max_distance)))
+        items = []
+    for group in group_by_budget(items, len(desc_q)):
+        dist = descriptor_distances(desc_q, np.vstack([desc for _, _, desc in group]), method)
+        offsets = np.cumsum([0] + [len(desc) for _, _, desc in group])
+        for (fname, pts, _), start, end in zip(group, offsets, offsets[1:]):
+            results.append((fname, match_and_inliers(pts_q, pts, dist[:, start:end], threshold, max_distance)))
     if verbose:
-        print(f"Processed {fname}: {inliers} inliers")
-    return fname, inliers
-
-def find_similar_images(directory, query_image, threshold, method="ORB", verbose=False, workers=4):
-    files = sorted(f for f in os.listdir(directory) if f.lower().endswith(('.png','.jpg','.jpeg')))
-    data_map = load_data(directory)
-    kp_q, desc_q = compute_features(query_image, method)
-    if kp_q is None:
+        for fname, inliers in results:
+            print(f"Processed {fname}: {'skipped by prefilter' if inliers is None else f'{inliers} inliers'}")
+    return results
+
+def find_similar_images(directory, query_image, threshold, method="ORB", verbose=False, workers=None, reduced=False, max_size=MAX_SIZE,
+                        max_hash_distance=None):
+    images = scan_images(directory)
+    workers = workers or os.cpu_count() or 4
+    pts_q, desc_q = load_query_features(query_image, directory, method, reduced, max_size)
+    if desc_q is None:
         print(f"Error: Cannot process query image {query_image}")
         return {}
+    # Scores depend on the query, its options and the threshold (the
+    # minimum RANSAC consensus), so only reuse ones saved with the same
+    settings = {"query": query_key(query_image, method, reduced, max_size), "threshold": threshold}
+    data_map = load_data(directory, settings)
+    phash_q = None
+    if max_hash_distance is not None:
+        phash_q = phash64(read_image(query_image, reduced, max_size))
 
-    to_process = [(f, directory, kp_q, desc_q, threshold, method, verbose) for f in files if f not in data_map]
-    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(to_process), desc="Processing images") as pbar:
-        futures = {executor.submit(process_image, args): args[0] for args in to_process}
-        for future in as_completed(futures):
-            fname, inliers = future.result()
-            data_map[fname] = inliers
-            with lock:
-                save_data(directory, data_map)
-            pbar.update(1)
+    to_process = []
+    empty = 0
+    for fname, stamp in images:
+        if fname in data_map:
+            continue
+        if stamp[1] == 0:
+            data_map[fname] = 0  # empty file, nothing to decode
+            empty += 1
+        else:
+            to_process.append((fname, stamp))
+    os.makedirs(os.path.join(directory, CACHE_DIR), exist_ok=True)
+    # Smaller batches on small directories so every worker gets some
+    size = max(1, min(MATCH_BATCH, -(-len(to_process) // workers)))
+    batches = [to_process[i:i + size] for i in range(0, len(to_process), size)]
+    # Feature extraction is CPU-bound, so use processes rather than threads;
+    # each task is a whole batch, which keeps pickling overhead per file low.
+    # Only plain arrays cross the process boundary (cv2.KeyPoint does not
+    # pickle); the query's sit in shared memory that every worker maps.
+    # By now the parent has touched CUDA (for the query) if it is in use,
+    # and a CUDA context cannot be inherited: spawn the workers instead
+    query_shm, query_specs = share_arrays(pts_q, desc_q)
+    mp_context = multiprocessing.get_context("spawn") if method == "ORB" and cuda_available() else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker,
+                                 initargs=(query_shm.name, query_specs)) as executor, \
+                tqdm(total=len(to_process), desc="Processing images", **progress_options()) as pbar:
+            futures = [executor.submit(process_batch, batch, directory, threshold, method, verbose, reduced, max_size,
+                                       phash_q, max_hash_distance) for batch in batches]
+            unsaved = empty
+            last_save = time.monotonic()
+            try:
+                for future in as_completed(futures):
+                    results = future.result()
+                    for fname, inliers in results:
+                        # Prefilter rejections are left out so a later run scores them
+                        if inliers is not None:
+                            data_map[fname] = inliers
+                    unsaved += len(results)
+                    pbar.update(len(results))
+                    if unsaved >= SAVE_EVERY or time.monotonic() - last_save > SAVE_INTERVAL:
+                        save_data(directory, data_map, settings)
+                        unsaved = 0
+                        last_save = time.monotonic()
+                    if shutdown_flag:
+                        break
+            finally:
+                # Drop batches that have not started and keep what is done so far
+                executor.shutdown(wait=True, cancel_futures=True)
+                if unsaved:
+                    save_data(directory, data_map, settings)
+    finally:
+        query_shm.close()
+        query_shm.unlink()
     return data_map
 
 
@@ -135,11 +810,19 @@ def main():
     parser.add_argument("query", help="Query image path")
     parser.add_argument("--threshold", type=int, default=10, help="Min inlier count for similarity")
     parser.add_argument("--method", choices=["ORB", "SIFT"], default="ORB", help="Feature detection method")
+    parser.add_argument("--reduced", action="store_true", help="Decode images at half resolution (faster, fewer features)")
+    parser.add_argument("--max-size", type=int, default=MAX_SIZE, help="Shrink images whose longer edge exceeds this many pixels before matching (0 to disable)")
+    parser.add_argument("--prefilter", type=int, metavar="BITS", help="Skip images whose perceptual hash differs from the query's in more than BITS of 64 bits (e.g. 24; misses heavy crops and rotations)")
     parser.add_argument("--verbose", action="store_true", help="Verbose output")
     parser.add_argument("--quiet", action="store_true", help="Suppress all output except results")
-    parser.add_argument("--workers", type=int, default=4, help="Number of parallel workers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Number of worker processes")
     args = parser.parse_args()
 
+    # Only the CLI prints the banner and takes over Ctrl+C; importing the
+    # module (as worker processes do under spawn) has no side effects
+    print(logo)
+    signal.signal(signal.SIGINT, handle_sigint)
+
     setup_logging(args.verbose and not args.quiet)
 
     if not args.quiet:
@@ -147,7 +830,7 @@ def main():
     else:
         show_summary = False
 
-    data_map = find_similar_images(args.directory, args.query, args.threshold, args.method, args.verbose and not args.quiet, args.workers)
+    data_map = find_similar_images(args.directory, args.query, args.threshold, args.method, args.verbose and not args.quiet, args.workers, args.reduced, args.max_size, args.prefilter)
     if show_summary:
         print_summary(data_map, args.threshold)
     results = sorted([(f,v) for f,v in data_map.items() if v > args.threshold], key=lambda x: x[1], reverse=True)